@@ -1,9 +1,15 @@
 import sounddevice as sd
 import numpy as np
-from scipy.fft import fft, fftfreq
+from scipy.fft import rfft, rfftfreq, next_fast_len
+from numba import njit
 import time
-import collections
+import math
+import struct
+from dataclasses import dataclass, field
 import sys # For sys.stdout.flush and sys.stdout.write
+import queue # Console output is handed off to a writer thread
+import threading
+import itertools
 import os # For file saving
 
 # --- Configuration ---
@@ -11,6 +17,7 @@ SAMPLING_RATE = 44100
 CHANNEL_DURATION = 0.03
 PREAMBLE_DURATION = 1.0
 FREQUENCY_TOLERANCE = 100
+SILENCE_RMS_THRESHOLD = 0.0035 # Blocks below this RMS are skipped (a tone with ~0.005 peak amplitude)
 
 # NOMINAL_CHANNEL_FREQUENCIES: Dynamically generated to fit 10kHz to 18kHz
 NOMINAL_CHANNEL_FREQUENCIES = {}
@@ -24,9 +31,49 @@ FREQ_STEP = (MAX_OPERATING_FREQ_HZ - MIN_OPERATING_FREQ_HZ) / (NUM_TOTAL_CHANNEL
 for i in range(1, NUM_TOTAL_CHANNELS + 1):
     NOMINAL_CHANNEL_FREQUENCIES[i] = MIN_OPERATING_FREQ_HZ + (i - 1) * FREQ_STEP
 
+# The same table as parallel arrays sorted by frequency, for the JIT-compiled helpers
+NOMINAL_CHANNEL_IDS = np.array(sorted(NOMINAL_CHANNEL_FREQUENCIES.keys()), dtype=np.int64)
+NOMINAL_CHANNEL_FREQS = np.array([NOMINAL_CHANNEL_FREQUENCIES[ch] for ch in NOMINAL_CHANNEL_IDS], dtype=np.float64)
+
 # --- Rest of the configuration remains the same ---
-BLOCKSIZE_SECONDS = 0.01
-BLOCKSIZE_SAMPLES = int(SAMPLING_RATE * BLOCKSIZE_SECONDS)
+BLOCKSIZE_SAMPLES = 256 # ~5.8 ms at 44.1 kHz; smaller blocks react faster to a new tone
+BLOCKSIZE_SECONDS = BLOCKSIZE_SAMPLES / SAMPLING_RATE
+
+# Blocks the audio callback can queue ahead of the decoder thread (~370 ms); further blocks are dropped
+AUDIO_RING_SLOTS = 64
+
+# Real-time (SCHED_FIFO) priority requested for the decoder thread. Linux only, and
+# needs CAP_SYS_NICE or an rtprio limit; otherwise the thread keeps its default priority.
+DECODER_THREAD_RT_PRIORITY = 70
+
+# The main thread parks on stop_event until the audio stream or the decoder worker stops.
+# An untimed wait is interrupted by Ctrl-C on POSIX; Windows lock waits are not, so there the
+# wait wakes up once a second to let KeyboardInterrupt through.
+MAIN_THREAD_WAIT_TIMEOUT = 1.0 if os.name == 'nt' else None
+
+# FFT length: BLOCKSIZE_SAMPLES zero-padded up to a size pocketfft handles quickly
+FFT_N = next_fast_len(BLOCKSIZE_SAMPLES, real=True)
+FFT_FREQS = rfftfreq(FFT_N, 1 / SAMPLING_RATE) # Bin frequencies, computed once
+# Bins covering the operating band (plus tolerance); the peak search ignores everything else,
+# so voice, hum and room noise outside 10-18 kHz can't win the argmax.
+FFT_BAND_LO = int(np.floor((MIN_OPERATING_FREQ_HZ - FREQUENCY_TOLERANCE) * FFT_N / SAMPLING_RATE))
+FFT_BAND_HI = min(int(np.ceil((MAX_OPERATING_FREQ_HZ + FREQUENCY_TOLERANCE) * FFT_N / SAMPLING_RATE)) + 1, FFT_N // 2 + 1)
+
+# Hann window for a full block, computed once, and a buffer the windowed block is written into
+HANN_WINDOW = np.hanning(BLOCKSIZE_SAMPLES).astype(np.float32)
+windowed_block = np.empty(BLOCKSIZE_SAMPLES, dtype=np.float32)
+fft_power = np.empty(FFT_N // 2 + 1, dtype=np.float32) # |rfft|^2 of the windowed block
+goertzel_s_prev = np.empty(NUM_TOTAL_CHANNELS, dtype=np.float32) # Goertzel recurrence state, one slot per channel
+goertzel_s_prev2 = np.empty(NUM_TOTAL_CHANNELS, dtype=np.float32)
+
+# Goertzel detector (used once calibrated): the strongest channel must hold at least this
+# fraction of N * (windowed block energy). With a Hann window over 256 samples (one bin ~172 Hz),
+# an on-frequency tone gives ~0.33, ~0.21 at 100 Hz off and ~0.10 at 160 Hz off, so tones are
+# accepted up to ~160 Hz from their calibrated frequency. That is wider than FREQUENCY_TOLERANCE
+# but still well inside half the 444 Hz channel spacing, so the strongest channel stays the
+# right one. Raising it to match +/-100 Hz would reject real tones whenever strong out-of-band
+# energy (e.g. a loud 1 kHz interferer) inflates the block energy.
+GOERTZEL_MIN_ENERGY_RATIO = 0.1
 
 DETECTION_THRESHOLD_FACTOR_CHANNEL = 0.51
 DETECTION_THRESHOLD_FACTOR_PREAMBLE = 0.7
@@ -34,6 +81,20 @@ DETECTION_THRESHOLD_FACTOR_PREAMBLE = 0.7
 MIN_CONSECUTIVE_BLOCKS_FOR_CHANNEL = max(1, int(np.ceil((CHANNEL_DURATION / BLOCKSIZE_SECONDS) * DETECTION_THRESHOLD_FACTOR_CHANNEL)))
 MIN_CONSECUTIVE_BLOCKS_FOR_PREAMBLE = max(1, int(np.ceil((PREAMBLE_DURATION / BLOCKSIZE_SECONDS) * DETECTION_THRESHOLD_FACTOR_PREAMBLE)))
 
+# Minimum block count indexed by channel ID: the preamble/postamble (Ch1) is a long tone
+MIN_BLOCKS_BY_CHANNEL = [MIN_CONSECUTIVE_BLOCKS_FOR_CHANNEL] * (NUM_TOTAL_CHANNELS + 1)
+MIN_BLOCKS_BY_CHANNEL[1] = MIN_CONSECUTIVE_BLOCKS_FOR_PREAMBLE
+MIN_BLOCKS_BY_CHANNEL = tuple(MIN_BLOCKS_BY_CHANNEL)
+
+RECENT_DETECTIONS_LEN = 3 # Blocks in the 2-of-3 majority vote
+
+FILE_WRITE_BUFFER_SIZE = 64 * 1024 # Received files are streamed to disk through a buffer of this size
+
+PROGRESS_BAR_MIN_INTERVAL = 1 / 30 # Seconds between progress bar redraws (the final byte always redraws)
+PROGRESS_BAR_LENGTH = 40
+# Every bar state, indexed by the number of '-' before the arrow, so a redraw builds no bar strings
+PROGRESS_BARS = tuple('-' * filled + '>' + ' ' * (PROGRESS_BAR_LENGTH - filled - 1) for filled in range(PROGRESS_BAR_LENGTH))
+
 # TRAINING_SEQUENCE: Channels 2, then 3, then 4-19 (still part of training)
 TRAINING_SEQUENCE = [2, 3] + list(range(4, 20)) 
 CALIBRATION_SANE_TOLERANCE_FACTOR = 0.075
@@ -43,238 +104,417 @@ HEADER_START_DELIMITER = 0xFE
 MESSAGE_TYPE_TEXT = 0x00
 MESSAGE_TYPE_FILE = 0x01
 HEADER_END_DELIMITER = 0xFF
+# Assembled byte indexed by [high nibble channel][low nibble channel]; Ch 4-19 carry nibbles 0-F
+BYTE_BY_NIBBLE_CHANNELS = tuple(
+    tuple(((high - 4) << 4) | (low - 4) if high >= 4 and low >= 4 else None for low in range(NUM_TOTAL_CHANNELS + 1))
+    for high in range(NUM_TOTAL_CHANNELS + 1)
+)
+UINT16_LE = struct.Struct('<H') # Header length fields
+UINT32_LE = struct.Struct('<I') # Header size fields
+
+# --- Decoder State ---
+@dataclass(slots=True)
+class FileMeta:
+    """Header metadata. For files, holds name/ext. For both, holds payload_size."""
+    filename: str = ""
+    extension: str = ""
+    payload_size: int = 0 # This will be the RAW data size (text or file)
+
+@dataclass(slots=True)
+class DecoderState:
+    """All mutable decoder/FSM state, kept on one object instead of ~25 module globals."""
+    state: str = "IDLE" # Can be IDLE, CALIBRATING, READING_HEADER, RECEIVING_DATA
+    current_message_channels_log: list = field(default_factory=list)
+    raw_decoded_payload_bytes: bytearray = field(default_factory=bytearray) # Stores all raw bytes after nibble assembly (header + actual data)
+
+    training_sequence_index: int = 0
+    calibrated_frequencies: dict = field(default_factory=dict)
+    has_been_calibrated: bool = False
+
+    # Calibrated channel table as parallel arrays, plus the Goertzel coefficients tuned to it.
+    # Rebuilt by set_calibrated_channel_arrays() once calibration completes.
+    calibrated_channel_ids: np.ndarray = field(default_factory=lambda: NOMINAL_CHANNEL_IDS)
+    calibrated_channel_freqs: np.ndarray = field(default_factory=lambda: NOMINAL_CHANNEL_FREQS)
+    # float32, so the per-channel recurrence in _analyze_block_nb runs in 8-wide SIMD lanes
+    goertzel_coeffs: np.ndarray = field(default_factory=lambda: (2 * np.cos(2 * np.pi * NOMINAL_CHANNEL_FREQS / SAMPLING_RATE)).astype(np.float32))
+    detect_block: object = None # Block detector for the current state, see detect_block_nominal()
+
+    # Tracking of the current tone detection
+    current_tone_candidate_nominal_chan: object = None
+    current_tone_candidate_blocks: int = 0
+    fsm_informed_of_this_segment: bool = False
+    # Last 3 per-block detections as a fixed ring buffer (the vote ignores order, so no rotation)
+    recent_detections_nominal_chan: list = field(default_factory=lambda: [None] * RECENT_DETECTIONS_LEN)
+    recent_detections_index: int = 0
+    recent_detections_count: int = 0
+    # Running sum/count of the current tone candidate's frequencies (mean is one division)
+    current_tone_candidate_freq_sum: float = 0.0
+    current_tone_candidate_freq_count: int = 0
+
+    # Byte assembly
+    current_high_nibble_channel: object = None # Channel ID (4-19) of the pending high nibble
+    byte_processing_state: str = "EXPECT_HIGH_NIBBLE" # One of: "EXPECT_HIGH_NIBBLE", "EXPECT_LOW_NIBBLE", "EXPECT_BYTE_SEPARATOR"
+    current_byte_channels_debug: list = field(default_factory=list) # For logging channels of current byte
+
+    # File/Message specific state
+    current_message_type: object = None
+    header_buffer: bytearray = field(default_factory=bytearray) # Temporarily stores bytes while header is being read
+    header_bytes_needed: int = 2 # parse_header() isn't re-run until header_buffer holds this many bytes
+    header_parsed: bool = False
+    file_metadata: FileMeta = field(default_factory=FileMeta)
+    payload_bytes_received: int = 0 # Tracks how many bytes of the actual data payload (after header) have been received
+    last_progress_bar_time: float = 0.0 # time.monotonic() of the last progress bar redraw
+    output_file: object = None # Open file the payload is streamed into (file messages only)
+
+DEC = DecoderState()
+
+# --- Audio Hand-off ---
+# audio_callback only copies each block into the next ring slot and queues the slot index;
+# decoder_worker() runs detection and the FSM on its own thread, off PortAudio's deadline.
+audio_ring = np.empty((AUDIO_RING_SLOTS, BLOCKSIZE_SAMPLES), dtype=np.float32)
+audio_ring_lengths = [BLOCKSIZE_SAMPLES] * AUDIO_RING_SLOTS # Valid samples per slot
+audio_ring_slots = itertools.cycle(range(AUDIO_RING_SLOTS)) # Next slot to write
+audio_ring_ready = queue.SimpleQueue() # Filled slot indices in arrival order; None stops the worker
+stop_event = threading.Event() # Set once the audio stream or decoder_worker() has stopped
+
+# --- Console Output ---
+log_queue = queue.SimpleQueue() # Messages produced on the decoder thread, written out by console_writer()
+
+def log(message, end="\n"):
+    """
+    Queues a console message. The decoder runs on decoder_worker(), whose priority is raised to
+    SCHED_FIFO where possible, so a blocking stdout write there would stall decoding; the actual
+    write happens on console_writer().
+    """
+    log_queue.put_nowait(message + end)
 
-# --- Decoder State Variables ---
-decoder_state = "IDLE" # Can be IDLE, CALIBRATING, READING_HEADER, RECEIVING_DATA
-current_message_channels_log = []
-raw_decoded_payload_bytes = [] # Stores all raw bytes after nibble assembly (header + actual data)
-
-training_sequence_index = 0
-calibrated_frequencies = {}
-has_been_calibrated = False
-
-# Variables for tracking current tone detection
-current_tone_candidate_nominal_chan = None
-current_tone_candidate_blocks = 0
-fsm_informed_of_this_segment = False
-recent_detections_nominal_chan = collections.deque(maxlen=3)
-current_tone_candidate_freq_samples = []
-
-# Global variables for byte assembly
-current_high_nibble_value = None # Stores 0-15
-byte_processing_state = "EXPECT_HIGH_NIBBLE" # One of: "EXPECT_HIGH_NIBBLE", "EXPECT_LOW_NIBBLE", "EXPECT_BYTE_SEPARATOR"
-current_byte_channels_debug = [] # For logging channels of current byte
-
-# File/Message specific variables
-current_message_type = None
-header_buffer = [] # Temporarily stores bytes while header is being read
-header_parsed = False
-file_metadata = { # For files, holds name/ext. For both, will hold payload_size
-    "filename": "",
-    "extension": "",
-    "payload_size": 0 # This will be the RAW data size (text or file)
-}
-payload_bytes_received = 0 # Tracks how many bytes of the actual data payload (after header) have been received
+def console_writer():
+    """Writes queued console messages until it receives None. Runs on its own thread."""
+    while True:
+        message = log_queue.get()
+        if message is None:
+            break
+        sys.stdout.write(message)
+        sys.stdout.flush()
 
 # --- Helper Functions for Bytes ---
-def bytes_to_int_le(byte_array):
-    """Converts a little-endian byte array to an integer."""
-    return int.from_bytes(byte_array, 'little')
-
 def get_channel_map_for_find():
     """Returns the calibrated frequency map if available, otherwise the nominal map."""
-    if has_been_calibrated and calibrated_frequencies and len(calibrated_frequencies) == len(NOMINAL_CHANNEL_FREQUENCIES):
-        return calibrated_frequencies
+    if DEC.has_been_calibrated and DEC.calibrated_frequencies and len(DEC.calibrated_frequencies) == len(NOMINAL_CHANNEL_FREQUENCIES):
+        return DEC.calibrated_frequencies
     return NOMINAL_CHANNEL_FREQUENCIES
 
-def find_closest_channel(frequency, use_nominal_map_only=False):
+def find_closest_channel(frequency):
     """
     Finds the closest nominal channel ID for a given frequency.
     """
     if frequency is None: return None
 
-    source_freq_map = NOMINAL_CHANNEL_FREQUENCIES
-    if not use_nominal_map_only and has_been_calibrated and len(calibrated_frequencies) == len(NOMINAL_CHANNEL_FREQUENCIES):
-        source_freq_map = calibrated_frequencies
-
-    min_diff = float('inf')
-    closest_channel_num = None
-
-    for channel_num, freq_val in source_freq_map.items():
-        diff = abs(frequency - freq_val)
-        if diff < min_diff and diff < FREQUENCY_TOLERANCE:
-            min_diff = diff
-            closest_channel_num = channel_num
-    return closest_channel_num
+    # Nominal channels are evenly spaced, so the nearest one is a single rounding step
+    closest_channel_num = round((frequency - MIN_OPERATING_FREQ_HZ) / FREQ_STEP) + 1
+    if 1 <= closest_channel_num <= NUM_TOTAL_CHANNELS and abs(frequency - NOMINAL_CHANNEL_FREQUENCIES[closest_channel_num]) < FREQUENCY_TOLERANCE:
+        return closest_channel_num
+    return None
+
+def apply_window(data):
+    """Returns data multiplied by the Hann window, reusing windowed_block for full-size blocks."""
+    if len(data) != BLOCKSIZE_SAMPLES:
+        return data * np.hanning(len(data)).astype(np.float32)
+    np.multiply(data, HANN_WINDOW, out=windowed_block)
+    return windowed_block
+
+@njit(cache=True, fastmath=True)
+def _power_spectrum_peak_nb(spectrum, power_out, lo, hi):
+    """
+    Returns the index of the largest |spectrum|^2 bin in [lo, hi), with lo >= 1 to skip DC.
+    The squared magnitude has the same peak as the magnitude, without a sqrt per bin.
+    Only bins lo-1 .. hi (the range plus its neighbours) are written into power_out.
+    """
+    peak_idx = lo
+    peak_power = -1.0
+    for i in range(lo - 1, min(hi + 1, spectrum.shape[0])):
+        power = spectrum[i].real * spectrum[i].real + spectrum[i].imag * spectrum[i].imag
+        power_out[i] = power
+        if lo <= i < hi and power > peak_power:
+            peak_power = power
+            peak_idx = i
+    return peak_idx
 
 def get_dominant_frequency(data, rate):
     """Calculates the dominant frequency in a given audio data segment."""
-    if len(data) == 0 or np.max(np.abs(data)) < 0.005:
+    if len(data) == 0:
         return None
-    window = np.hanning(len(data))
-    data = data * window
-    N = len(data)
-    yf = fft(data)
-    xf = fftfreq(N, 1 / rate)
-    positive_mask = xf > 0
-    xf_positive = xf[positive_mask]
-    yf_positive = np.abs(yf[positive_mask])
+    data = apply_window(data)
+    # rfft only computes the non-negative half of the spectrum for real input.
+    # float32 input runs the single-precision kernel and returns complex64.
+    # One worker: a ~256 point transform is far too small to gain from threading.
+    yf = rfft(data, n=FFT_N, overwrite_x=True, workers=1) # data is our scratch buffer, pocketfft may reuse it
+    xf = FFT_FREQS if rate == SAMPLING_RATE else rfftfreq(FFT_N, 1 / rate)
 
-    if len(yf_positive) == 0: return None
+    if len(yf) < 2: return None
 
-    try:
-        idx = np.argmax(yf_positive)
-        return xf_positive[idx]
-    except IndexError:
+    if rate == SAMPLING_RATE:
+        idx = _power_spectrum_peak_nb(yf, fft_power, FFT_BAND_LO, FFT_BAND_HI)
+    else:
+        idx = _power_spectrum_peak_nb(yf, fft_power, 1, len(yf))
+
+    if idx < len(fft_power) - 1:
+        # Fit a parabola through the log-powers around the peak for sub-bin accuracy (log power is
+        # twice log magnitude, so the offset is the same). Scalar logs: np.log on a slice would
+        # allocate two temporary arrays per block.
+        alpha = math.log(fft_power[idx - 1] + 1e-12)
+        beta = math.log(fft_power[idx] + 1e-12)
+        gamma = math.log(fft_power[idx + 1] + 1e-12)
+        denominator = alpha - 2 * beta + gamma
+        if denominator < 0:
+            offset = 0.5 * (alpha - gamma) / denominator
+            return float(xf[idx] + offset * (xf[1] - xf[0]))
+    return float(xf[idx]) # Plain float: numpy scalars are slower in the per-block Python arithmetic
+
+def set_calibrated_channel_arrays(freq_map):
+    """Rebuilds the calibrated channel arrays and retunes the Goertzel filter bank to freq_map."""
+    DEC.calibrated_channel_ids = np.array(list(freq_map.keys()), dtype=np.int64)
+    DEC.calibrated_channel_freqs = np.array([freq_map[ch] for ch in DEC.calibrated_channel_ids], dtype=np.float64)
+    DEC.goertzel_coeffs = (2 * np.cos(2 * np.pi * DEC.calibrated_channel_freqs / SAMPLING_RATE)).astype(np.float32)
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def _analyze_block_nb(data, window, coeffs, channel_ids, min_energy_ratio, s_prev, s_prev2):
+    """
+    Windows data, runs one Goertzel recurrence per coefficient and picks the strongest channel,
+    all in a single pass over the block. s_prev/s_prev2 are caller-owned scratch for the
+    recurrence state. Returns the channel ID, or -1 if no channel dominates.
+    """
+    n_channels = coeffs.shape[0]
+    s_prev[:n_channels] = 0.0
+    s_prev2[:n_channels] = 0.0
+    energy = 0.0
+    for i in range(data.shape[0]):
+        x = data[i] * window[i]
+        energy += x * x
+        for k in range(n_channels): # s[n] = coeff * s[n-1] - s[n-2] + x[n]
+            s = coeffs[k] * s_prev[k] - s_prev2[k] + x
+            s_prev2[k] = s_prev[k]
+            s_prev[k] = s
+    best_idx = 0
+    best_power = -1.0
+    for k in range(n_channels):
+        power = s_prev[k] * s_prev[k] + s_prev2[k] * s_prev2[k] - coeffs[k] * s_prev[k] * s_prev2[k]
+        if power > best_power:
+            best_power = power
+            best_idx = k
+    if best_power < min_energy_ratio * data.shape[0] * energy:
+        return -1 # Energy is spread out or outside the channel frequencies
+    return channel_ids[best_idx]
+
+def get_dominant_channel(data):
+    """
+    Runs a Goertzel filter bank over the audio block, evaluating the spectrum only at the
+    channel frequencies. Returns the strongest channel ID, or None if no channel dominates.
+    """
+    if len(data) == 0:
         return None
+    window = HANN_WINDOW if len(data) == BLOCKSIZE_SAMPLES else np.hanning(len(data)).astype(np.float32)
+    channel = _analyze_block_nb(data, window, DEC.goertzel_coeffs, DEC.calibrated_channel_ids, GOERTZEL_MIN_ENERGY_RATIO,
+                                goertzel_s_prev, goertzel_s_prev2)
+    return int(channel) if channel >= 0 else None
+
+def detect_block_nominal(data):
+    """
+    Block detector for IDLE/CALIBRATING. Preamble and calibration need the actual received
+    frequency, so this runs the full FFT and matches the result against the nominal channels.
+    Returns (channel ID or None, frequency or None).
+    """
+    frequency = get_dominant_frequency(data, SAMPLING_RATE)
+    if frequency is None:
+        return None, None
+    return find_closest_channel(frequency), frequency
+
+def detect_block_calibrated(data):
+    """
+    Block detector for READING_HEADER/RECEIVING_DATA. Only the energy at each calibrated
+    channel frequency matters, so this runs the Goertzel bank.
+    Returns (channel ID or None, calibrated frequency of that channel or None).
+    """
+    channel = get_dominant_channel(data)
+    return channel, DEC.calibrated_frequencies.get(channel)
+
+# Detector for the current decoder state. Swapped on the two transitions that change it
+# (calibration complete, decoder reset) so audio_callback doesn't re-check the state per block.
+DEC.detect_block = detect_block_nominal
+
+# Compile the JIT helpers and build the cached FFT plan now so the first audio block isn't delayed
+_analyze_block_nb(np.zeros(BLOCKSIZE_SAMPLES, dtype=np.float32), HANN_WINDOW, DEC.goertzel_coeffs, DEC.calibrated_channel_ids, GOERTZEL_MIN_ENERGY_RATIO,
+                  goertzel_s_prev, goertzel_s_prev2)
+get_dominant_frequency(np.zeros(BLOCKSIZE_SAMPLES, dtype=np.float32), SAMPLING_RATE)
 
 def reset_decoder_state_variables():
     """Resets all decoder state variables to their initial values."""
-    global decoder_state, current_message_channels_log, raw_decoded_payload_bytes, training_sequence_index
-    global current_tone_candidate_nominal_chan, current_tone_candidate_blocks, fsm_informed_of_this_segment
-    global current_tone_candidate_freq_samples
-    global current_high_nibble_value, byte_processing_state, current_byte_channels_debug
-    global current_message_type, header_buffer, header_parsed, file_metadata, payload_bytes_received
-
-    decoder_state = "IDLE"
-    current_message_channels_log = []
-    raw_decoded_payload_bytes = []
-    training_sequence_index = 0
-    current_tone_candidate_nominal_chan = None
-    current_tone_candidate_blocks = 0
-    fsm_informed_of_this_segment = False
-    recent_detections_nominal_chan.clear()
-    current_tone_candidate_freq_samples = []
-
-    current_high_nibble_value = None
-    byte_processing_state = "EXPECT_HIGH_NIBBLE"
-    current_byte_channels_debug = []
+    DEC.state = "IDLE"
+    DEC.detect_block = detect_block_nominal
+    DEC.current_message_channels_log = []
+    DEC.raw_decoded_payload_bytes = bytearray()
+    DEC.training_sequence_index = 0
+    DEC.current_tone_candidate_nominal_chan = None
+    DEC.current_tone_candidate_blocks = 0
+    DEC.fsm_informed_of_this_segment = False
+    DEC.recent_detections_count = 0
+    DEC.current_tone_candidate_freq_sum = 0.0
+    DEC.current_tone_candidate_freq_count = 0
+
+    DEC.current_high_nibble_channel = None
+    DEC.byte_processing_state = "EXPECT_HIGH_NIBBLE"
+    DEC.current_byte_channels_debug = []
 
     # File/Message specific variables reset
-    current_message_type = None
-    header_buffer = []
-    header_parsed = False
-    file_metadata = {
-        "filename": "",
-        "extension": "",
-        "payload_size": 0 # Reset to 0
-    }
-    payload_bytes_received = 0
+    DEC.current_message_type = None
+    DEC.header_buffer = bytearray()
+    DEC.header_bytes_needed = 2
+    DEC.header_parsed = False
+    DEC.file_metadata.filename = ""
+    DEC.file_metadata.extension = ""
+    DEC.file_metadata.payload_size = 0
+    DEC.payload_bytes_received = 0
+    DEC.last_progress_bar_time = 0.0
+    if DEC.output_file is not None:
+        DEC.output_file.close()
+        DEC.output_file = None
 
 
 def reset_decoder_soft():
     """Soft reset: Clears message data but keeps calibration."""
-    print("Decoder soft reset. Waiting for preamble...")
+    log("Decoder soft reset. Waiting for preamble...")
     reset_decoder_state_variables()
 
 def reset_decoder_full_including_calibration():
     """Full reset: Clears everything including calibration data."""
-    global calibrated_frequencies, has_been_calibrated
-    print("Decoder FULL reset (calibration lost). Waiting for preamble...")
-    calibrated_frequencies = {}
-    has_been_calibrated = False
+    log("Decoder FULL reset (calibration lost). Waiting for preamble...")
+    DEC.calibrated_frequencies = {}
+    DEC.has_been_calibrated = False
     reset_decoder_state_variables()
 
-def print_progress_bar(current, total, bar_length=40):
+def print_progress_bar(current, total):
     if total == 0: # Avoid division by zero
         percent = 0
     else:
         percent = float(current) / total
-    arrow = '-' * int(round(percent * bar_length) - 1) + '>'
-    spaces = ' ' * (bar_length - len(arrow))
-    sys.stdout.write(f"\rReceiving: [{arrow + spaces}] {int(percent * 100)}% ({current}/{total} bytes)")
-    sys.stdout.flush()
+    filled = min(max(int(round(percent * PROGRESS_BAR_LENGTH)) - 1, 0), PROGRESS_BAR_LENGTH - 1)
+    log(f"\rReceiving: [{PROGRESS_BARS[filled]}] {int(percent * 100)}% ({current}/{total} bytes)", end="")
 
 def reset_decoder_after_message_or_error():
     """Called after a message is completed/interrupted or an error occurs."""
-    global raw_decoded_payload_bytes, current_message_channels_log, current_message_type
-    global file_metadata, payload_bytes_received
 
     # Clear any live message/progress bar from the console
-    sys.stdout.write("\r" + " " * 80 + "\r")
-    sys.stdout.flush()
-
-    print(f"\n--- MESSAGE END / DECODER RESET ---")
-    if decoder_state == "CALIBRATING" and not has_been_calibrated:
-         print(f"Status: Calibration failed or interrupted.")
-    elif not raw_decoded_payload_bytes and (decoder_state == "RECEIVING_DATA" or decoder_state == "READING_HEADER" or (decoder_state == "IDLE" and current_message_channels_log)):
-        print(f"Status: Message/File decoding failed or interrupted (no data received or partial header).")
-    elif raw_decoded_payload_bytes:
+    log("\r" + " " * 80 + "\r", end="")
+
+    log(f"\n--- MESSAGE END / DECODER RESET ---")
+    if DEC.state == "CALIBRATING" and not DEC.has_been_calibrated:
+         log(f"Status: Calibration failed or interrupted.")
+    elif not DEC.raw_decoded_payload_bytes and (DEC.state == "RECEIVING_DATA" or DEC.state == "READING_HEADER" or (DEC.state == "IDLE" and DEC.current_message_channels_log)):
+        log(f"Status: Message/File decoding failed or interrupted (no data received or partial header).")
+    elif DEC.raw_decoded_payload_bytes:
         # The raw_decoded_payload_bytes contains header + actual data payload.
         # We need to extract only the actual data payload part.
         
         raw_data_payload = b''
-        if header_parsed:
+        if DEC.output_file is not None:
+            pass # File payload was streamed to disk, only the header is in memory
+        elif DEC.header_parsed:
             # The start of the data payload is current length of raw_decoded_payload_bytes - payload_bytes_received
-            data_start_idx = len(raw_decoded_payload_bytes) - payload_bytes_received
+            data_start_idx = len(DEC.raw_decoded_payload_bytes) - DEC.payload_bytes_received
             if data_start_idx >= 0:
-                raw_data_payload = bytes(raw_decoded_payload_bytes[data_start_idx:])
+                raw_data_payload = bytes(DEC.raw_decoded_payload_bytes[data_start_idx:])
             else:
-                print("Warning: Could not extract raw data payload due to index error. Raw payload might be corrupted.")
+                log("Warning: Could not extract raw data payload due to index error. Raw payload might be corrupted.")
         else:
-            print("Warning: Cannot process data, header was not fully parsed.")
+            log("Warning: Cannot process data, header was not fully parsed.")
 
-        if current_message_type == MESSAGE_TYPE_FILE:
-            file_name = file_metadata["filename"]
-            file_ext = file_metadata["extension"]
-            full_path = f"{file_name}.{file_ext}" if file_ext else file_name
+        if DEC.current_message_type == MESSAGE_TYPE_FILE:
+            file_name = DEC.file_metadata.filename
+            file_ext = DEC.file_metadata.extension
+            full_path = received_file_path()
             
             try:
-                with open(full_path, 'wb') as f:
-                    f.write(raw_data_payload)
-                print(f"Status: File '{full_path}' successfully received and saved ({len(raw_data_payload)} bytes).")
+                if DEC.output_file is not None:
+                    output_file, DEC.output_file = DEC.output_file, None
+                    output_file.close() # Flushes the remaining buffered payload
+                    saved_bytes = DEC.payload_bytes_received
+                else: # Could not be opened at header time; write the in-memory payload
+                    with open(full_path, 'wb') as f:
+                        f.write(raw_data_payload)
+                    saved_bytes = len(raw_data_payload)
+                log(f"Status: File '{full_path}' successfully received and saved ({saved_bytes} bytes).")
             except IOError as e:
-                print(f"Status: File '{full_path}' received, but failed to save: {e}")
+                log(f"Status: File '{full_path}' received, but failed to save: {e}")
             
-            print(f"Metadata - Payload Size: {file_metadata['payload_size']} bytes")
-            print(f"  Filename: '{file_name}', Extension: '{file_ext}'")
-        elif current_message_type == MESSAGE_TYPE_TEXT:
+            log(f"Metadata - Payload Size: {DEC.file_metadata.payload_size} bytes")
+            log(f"  Filename: '{file_name}', Extension: '{file_ext}'")
+        elif DEC.current_message_type == MESSAGE_TYPE_TEXT:
             try:
                 decoded_text = raw_data_payload.decode('utf-8')
-                print(f"Status: Text message decoded successfully.")
-                print(f"Decoded Message: '{decoded_text}'")
+                log(f"Status: Text message decoded successfully.")
+                log(f"Decoded Message: '{decoded_text}'")
             except UnicodeDecodeError:
-                print(f"Status: Text message received, but could not be decoded as UTF-8.")
-                print(f"Raw Bytes (first 50): {raw_data_payload[:50]}")
+                log(f"Status: Text message received, but could not be decoded as UTF-8.")
+                log(f"Raw Bytes (first 50): {raw_data_payload[:50]}")
         else: # Should not happen if message_type is set
-            print(f"Status: Unknown message type detected ({current_message_type}). Raw payload received.")
+            log(f"Status: Unknown message type detected ({DEC.current_message_type}). Raw payload received.")
             
     else:
-        print(f"Status: Reset triggered without significant message activity.")
+        log(f"Status: Reset triggered without significant message activity.")
 
-    print(f"Raw Confirmed Channels (Detected IDs): {current_message_channels_log}")
-    print(f"Raw Assembled Payload Bytes (Hex, first 50): {[f'{b:02X}' for b in raw_decoded_payload_bytes[:50]]}...")
+    log(f"Raw Confirmed Channels (Detected IDs): {DEC.current_message_channels_log}")
+    log(f"Raw Assembled Payload Bytes (Hex, first 50): {[f'{b:02X}' for b in DEC.raw_decoded_payload_bytes[:50]]}...")
 
-    if has_been_calibrated and calibrated_frequencies:
-        print("\nCurrent Calibrated Frequencies (Hz):")
-        for ch_num in sorted(calibrated_frequencies.keys()):
+    if DEC.has_been_calibrated and DEC.calibrated_frequencies:
+        log("\nCurrent Calibrated Frequencies (Hz):")
+        for ch_num in sorted(DEC.calibrated_frequencies.keys()):
             if ch_num in NOMINAL_CHANNEL_FREQUENCIES:
-                print(f"  Ch {ch_num:2d}: {calibrated_frequencies[ch_num]:.1f} (Nominal: {NOMINAL_CHANNEL_FREQUENCIES[ch_num]:.1f})")
-    print("-----------------------------------\n")
+                log(f"  Ch {ch_num:2d}: {DEC.calibrated_frequencies[ch_num]:.1f} (Nominal: {NOMINAL_CHANNEL_FREQUENCIES[ch_num]:.1f})")
+    log("-----------------------------------\n")
 
     reset_decoder_state_variables()
 
+def received_file_path():
+    """Returns the path a received file is saved to, built from the header metadata."""
+    file_name = DEC.file_metadata.filename
+    file_ext = DEC.file_metadata.extension
+    return f"{file_name}.{file_ext}" if file_ext else file_name
+
+def open_output_file():
+    """Opens the received file so its payload can be written to disk as it arrives."""
+    full_path = received_file_path()
+    try:
+        DEC.output_file = open(full_path, 'wb', buffering=FILE_WRITE_BUFFER_SIZE)
+    except IOError as e:
+        log(f"Warning: Could not open '{full_path}' for writing ({e}). Buffering payload in memory.")
+        DEC.output_file = None
+
 def process_decoded_byte(byte_value):
     """
     Handles appending a newly assembled byte to either the header_buffer or
     the raw_decoded_payload_bytes, and triggers header parsing or progress updates.
     """
-    global header_parsed, raw_decoded_payload_bytes, payload_bytes_received
-    global decoder_state # Need to update state if header parsing completes
 
-    if not header_parsed:
-        header_buffer.append(byte_value)
-        if parse_header(): # parse_header also updates header_parsed and decoder_state to RECEIVING_DATA
+    if not DEC.header_parsed:
+        DEC.header_buffer.append(byte_value)
+        # parse_header also updates header_parsed and the state to RECEIVING_DATA
+        if len(DEC.header_buffer) >= DEC.header_bytes_needed and parse_header():
             # Header is now parsed. Copy header_buffer contents to payload.
-            raw_decoded_payload_bytes.extend(header_buffer) 
-            header_buffer.clear() # Clear buffer as it's been processed
+            DEC.raw_decoded_payload_bytes.extend(DEC.header_buffer) 
+            DEC.header_buffer.clear() # Clear buffer as it's been processed
     else: # Header is already parsed, so we are receiving data payload
-        raw_decoded_payload_bytes.append(byte_value)
-        payload_bytes_received += 1
-        print_progress_bar(payload_bytes_received, file_metadata["payload_size"])
+        if DEC.output_file is not None:
+            DEC.output_file.write(bytes((byte_value,))) # Buffered; file payloads aren't kept in memory
+        else:
+            DEC.raw_decoded_payload_bytes.append(byte_value)
+        DEC.payload_bytes_received += 1
+        now = time.monotonic()
+        if now - DEC.last_progress_bar_time >= PROGRESS_BAR_MIN_INTERVAL or DEC.payload_bytes_received == DEC.file_metadata.payload_size:
+            print_progress_bar(DEC.payload_bytes_received, DEC.file_metadata.payload_size)
+            DEC.last_progress_bar_time = now
         # Check if all payload bytes are received
-        if payload_bytes_received >= file_metadata["payload_size"] and file_metadata["payload_size"] > 0:
-            print(f"\nAll payload data ({payload_bytes_received} bytes) received. Waiting for Postamble...")
+        if DEC.payload_bytes_received >= DEC.file_metadata.payload_size and DEC.file_metadata.payload_size > 0:
+            log(f"\nAll payload data ({DEC.payload_bytes_received} bytes) received. Waiting for Postamble...")
             # The decoder state remains "RECEIVING_DATA" until postamble or error
             # We do NOT reset here. The postamble triggers final reset and processing.
 
@@ -283,130 +523,192 @@ def parse_header():
     """
     Attempts to parse the header from header_buffer.
     Returns True if header is complete and valid, False otherwise.
-    Sets global file_metadata and current_message_type.
+    Sets file_metadata and current_message_type on DEC. When more bytes are needed,
+    sets header_bytes_needed to the length at which parsing can make progress again.
     """
-    global header_parsed, current_message_type, file_metadata, decoder_state
 
     # Minimum header size: START (1) + TYPE (1) + PAYLOAD_SIZE (4) + END (1) = 7 bytes for text
     # Minimum fixed part for file is more complex due to dynamic length fields.
 
-    if len(header_buffer) < 2: # Need at least start delimiter and message type
+    if len(DEC.header_buffer) < 2: # Need at least start delimiter and message type
         return False
 
-    if header_buffer[0] != HEADER_START_DELIMITER:
-        print(f"Error: Header does not start with delimiter {HEADER_START_DELIMITER:02X}. Resetting.")
+    if DEC.header_buffer[0] != HEADER_START_DELIMITER:
+        log(f"Error: Header does not start with delimiter {HEADER_START_DELIMITER:02X}. Resetting.")
         reset_decoder_after_message_or_error()
         return False
 
-    current_message_type = header_buffer[1]
+    DEC.current_message_type = DEC.header_buffer[1]
 
-    if current_message_type == MESSAGE_TYPE_TEXT:
+    if DEC.current_message_type == MESSAGE_TYPE_TEXT:
         # Text header: FE (1) + 00 (1) + DATA_SIZE (4) + FF (1) = 7 bytes
-        if len(header_buffer) < 7:
+        if len(DEC.header_buffer) < 7:
+            DEC.header_bytes_needed = 7
             return False # Not enough bytes for full text header yet
 
-        if header_buffer[6] != HEADER_END_DELIMITER:
-            print(f"Error: Text header does not end with delimiter {HEADER_END_DELIMITER:02X}. Resetting.")
+        if DEC.header_buffer[6] != HEADER_END_DELIMITER:
+            log(f"Error: Text header does not end with delimiter {HEADER_END_DELIMITER:02X}. Resetting.")
             reset_decoder_after_message_or_error()
             return False
         
-        file_metadata["payload_size"] = bytes_to_int_le(header_buffer[2:6])
-        header_parsed = True
-        print(f"Text Message Header Parsed. Raw Data Size: {file_metadata['payload_size']} bytes. Waiting for raw text data.")
-        decoder_state = "RECEIVING_DATA" # Transition to receiving data payload
+        (DEC.file_metadata.payload_size,) = UINT32_LE.unpack_from(DEC.header_buffer, 2)
+        DEC.header_parsed = True
+        log(f"Text Message Header Parsed. Raw Data Size: {DEC.file_metadata.payload_size} bytes. Waiting for raw text data.")
+        DEC.state = "RECEIVING_DATA" # Transition to receiving data payload
         return True
 
-    elif current_message_type == MESSAGE_TYPE_FILE:
+    elif DEC.current_message_type == MESSAGE_TYPE_FILE:
         # File header: FE (1) + 01 (1) + FNL (2) + FN (N) + EL (2) + EXT (N) + FS (4) + FF (1)
         # Minimum fixed part: Start, Type, FNL, EL, FS, End = 1+1+2+2+4+1 = 11 bytes
         fixed_file_header_min_len = 11 
-        if len(header_buffer) < fixed_file_header_min_len:
+        if len(DEC.header_buffer) < fixed_file_header_min_len:
+            DEC.header_bytes_needed = fixed_file_header_min_len
             return False # Not enough bytes for fixed part of file header yet
 
         # Extract lengths and sizes to determine full header length
         try:
-            filename_len = bytes_to_int_le(header_buffer[2:4])
+            (filename_len,) = UINT16_LE.unpack_from(DEC.header_buffer, 2)
             
             # Calculate where extension length bytes *should* start
             ext_len_start_idx = 4 + filename_len
-            if len(header_buffer) < ext_len_start_idx + 2: return False # Not enough for ext length yet
+            if len(DEC.header_buffer) < ext_len_start_idx + 2: # Not enough for ext length yet
+                DEC.header_bytes_needed = ext_len_start_idx + 2
+                return False
 
-            extension_len = bytes_to_int_le(header_buffer[ext_len_start_idx : ext_len_start_idx + 2])
+            (extension_len,) = UINT16_LE.unpack_from(DEC.header_buffer, ext_len_start_idx)
 
             # Calculate where file size bytes *should* start
             file_size_start_idx = ext_len_start_idx + 2 + extension_len
-            if len(header_buffer) < file_size_start_idx + 4: return False # Not enough for file size yet
+            if len(DEC.header_buffer) < file_size_start_idx + 4: # Not enough for file size yet
+                DEC.header_bytes_needed = file_size_start_idx + 4
+                return False
 
-            file_size = bytes_to_int_le(header_buffer[file_size_start_idx : file_size_start_idx + 4])
+            (file_size,) = UINT32_LE.unpack_from(DEC.header_buffer, file_size_start_idx)
             
             # Calculate where the HEADER_END_DELIMITER *should* be
             end_delimiter_idx = file_size_start_idx + 4
 
-            if len(header_buffer) < end_delimiter_idx + 1: return False # Need end delimiter
+            if len(DEC.header_buffer) < end_delimiter_idx + 1: # Need end delimiter
+                DEC.header_bytes_needed = end_delimiter_idx + 1
+                return False
 
-            if header_buffer[end_delimiter_idx] != HEADER_END_DELIMITER:
-                print(f"Error: File header does not end with delimiter {HEADER_END_DELIMITER:02X}. Resetting.")
+            if DEC.header_buffer[end_delimiter_idx] != HEADER_END_DELIMITER:
+                log(f"Error: File header does not end with delimiter {HEADER_END_DELIMITER:02X}. Resetting.")
                 reset_decoder_after_message_or_error()
                 return False
 
             # All parts present, now extract strings
-            filename_bytes = bytes(header_buffer[4 : 4 + filename_len])
-            extension_bytes = bytes(header_buffer[ext_len_start_idx + 2 : ext_len_start_idx + 2 + extension_len])
+            # Decode the strings in place through a memoryview, without slice copies. The view is
+            # released on exit so header_buffer can be resized (cleared) afterwards.
+            with memoryview(DEC.header_buffer) as header:
+                DEC.file_metadata.filename = str(header[4 : 4 + filename_len], 'utf-8')
+                DEC.file_metadata.extension = str(header[ext_len_start_idx + 2 : ext_len_start_idx + 2 + extension_len], 'utf-8')
+            DEC.file_metadata.payload_size = file_size # This is the RAW file size
             
-            file_metadata["filename"] = filename_bytes.decode('utf-8')
-            file_metadata["extension"] = extension_bytes.decode('utf-8')
-            file_metadata["payload_size"] = file_size # This is the RAW file size
-            
-            header_parsed = True
-            print(f"File Header Parsed. Filename: '{file_metadata['filename']}.{file_metadata['extension']}', "
-                  f"Payload Size: {file_metadata['payload_size']} bytes. Waiting for raw file data.")
-            decoder_state = "RECEIVING_DATA" # Transition to receiving data payload
+            DEC.header_parsed = True
+            log(f"File Header Parsed. Filename: '{DEC.file_metadata.filename}.{DEC.file_metadata.extension}', "
+                  f"Payload Size: {DEC.file_metadata.payload_size} bytes. Waiting for raw file data.")
+            open_output_file()
+            DEC.state = "RECEIVING_DATA" # Transition to receiving data payload
             return True
 
-        except (IndexError, UnicodeDecodeError, ValueError) as e:
-            print(f"Error parsing file header: {e}. Header buffer: {header_buffer}. Resetting.")
+        except (IndexError, UnicodeDecodeError, ValueError, struct.error) as e:
+            log(f"Error parsing file header: {e}. Header buffer: {list(DEC.header_buffer)}. Resetting.")
             reset_decoder_after_message_or_error()
             return False
     else:
-        print(f"Error: Unknown message type {current_message_type:02X}. Resetting.")
+        log(f"Error: Unknown message type {DEC.current_message_type:02X}. Resetting.")
         reset_decoder_after_message_or_error()
         return False
         
 
+# --- Message-phase channel handlers (READING_HEADER / RECEIVING_DATA) ---
+def handle_postamble(data_channel, actual_average_frequency):
+    log(f"Postamble Confirmed (Calibrated Ch 1 @ {actual_average_frequency:.1f} Hz).")
+    # If we received a postamble, it means message is done. Handle incomplete states.
+    if DEC.header_parsed:
+        if DEC.payload_bytes_received < DEC.file_metadata.payload_size:
+            log(f"  Warning: Payload transmission ended prematurely. Expected {DEC.file_metadata.payload_size} bytes, got {DEC.payload_bytes_received}.")
+    else: # Header was not parsed completely
+        log(f"  Warning: Message ended without a complete header. Current header_buffer: {[f'{b:02X}' for b in DEC.header_buffer]}.")
+
+    reset_decoder_after_message_or_error()
+
+def handle_hex_nibble(data_channel, actual_average_frequency): # Ch 4-19: hex digit (0-F)
+    DEC.current_byte_channels_debug.append(data_channel)
+
+    if DEC.byte_processing_state == "EXPECT_HIGH_NIBBLE":
+        DEC.current_high_nibble_channel = data_channel
+        DEC.byte_processing_state = "EXPECT_LOW_NIBBLE"
+    elif DEC.byte_processing_state == "EXPECT_LOW_NIBBLE":
+        if DEC.current_high_nibble_channel is not None:
+            full_byte_val = BYTE_BY_NIBBLE_CHANNELS[DEC.current_high_nibble_channel][data_channel]
+            process_decoded_byte(full_byte_val) # Call helper here
+            DEC.current_high_nibble_channel = None
+            DEC.byte_processing_state = "EXPECT_BYTE_SEPARATOR"
+            DEC.current_byte_channels_debug = []
+        else:
+            log(f"Error: Low Nibble (Ch {data_channel}) received without a registered High Nibble. Resetting.")
+            reset_decoder_after_message_or_error()
+    else:
+        log(f"Error: Hex digit Ch {data_channel} received at unexpected state ({DEC.byte_processing_state}). Resetting.")
+        reset_decoder_after_message_or_error()
+
+def handle_byte_separator(data_channel, actual_average_frequency): # Ch 2
+    DEC.current_byte_channels_debug.append(data_channel)
+    if DEC.byte_processing_state == "EXPECT_BYTE_SEPARATOR":
+        DEC.byte_processing_state = "EXPECT_HIGH_NIBBLE"
+    elif DEC.byte_processing_state == "EXPECT_LOW_NIBBLE" and DEC.current_high_nibble_channel is not None:
+        # --- ERROR RECOVERY (Duplicate Nibble) - Warning suppressed ---
+        # log(f"Warning: Missing Low Nibble for byte (expected Ch 4-19, got Ch 2). Assuming duplicate of High Nibble ({DEC.current_high_nibble_channel - 4:X}).")
+        full_byte_val = BYTE_BY_NIBBLE_CHANNELS[DEC.current_high_nibble_channel][DEC.current_high_nibble_channel]
+        process_decoded_byte(full_byte_val) # Process the reconstructed byte
+
+        DEC.current_high_nibble_channel = None # Clear for next byte
+        DEC.byte_processing_state = "EXPECT_HIGH_NIBBLE" # Ready for next byte's high nibble
+        DEC.current_byte_channels_debug = [] # Clear debug for this "repaired" byte
+    else:
+        log(f"Error: Byte Separator (Ch 2) received at unexpected state ({DEC.byte_processing_state}). Resetting.")
+        reset_decoder_after_message_or_error()
+
+def handle_training_channel(data_channel, actual_average_frequency): # Ch3 is only part of calibration/training now. If seen during message, it's an error.
+    log(f"Error: Ch 3 detected in message phase. This channel is not used as a separator anymore. Resetting.")
+    reset_decoder_after_message_or_error()
+
+def handle_unexpected_channel(data_channel, actual_average_frequency):
+    log(f"Warning: Unexpected Ch {data_channel} ({actual_average_frequency:.1f} Hz) in message state. Resetting message attempt.")
+    reset_decoder_after_message_or_error()
+
+# Message-phase handler indexed by channel ID, so each symbol is one lookup instead of an if/elif ladder
+MESSAGE_CHANNEL_HANDLERS = [handle_unexpected_channel, handle_postamble, handle_byte_separator, handle_training_channel] + \
+                           [handle_hex_nibble] * 16
+
 def fsm_process_confirmed_tone(confirmed_channel_id_used_for_detection, actual_average_frequency):
     """
     State machine for processing confirmed tones.
     Manages calibration, message decoding, and state transitions.
     """
-    global decoder_state, training_sequence_index, raw_decoded_payload_bytes
-    global current_message_channels_log, calibrated_frequencies, has_been_calibrated
-    global current_high_nibble_value, byte_processing_state, current_byte_channels_debug
-    global header_buffer, header_parsed, payload_bytes_received
-    # Add these globals for the added reset after calibration
-    global current_tone_candidate_nominal_chan, current_tone_candidate_blocks, fsm_informed_of_this_segment, current_tone_candidate_freq_samples, recent_detections_nominal_chan
-
-
-    if decoder_state == "IDLE":
+    if DEC.state == "IDLE":
         if confirmed_channel_id_used_for_detection == 1:
-            print(f"Preamble Confirmed (Nominal Ch 1 @ {actual_average_frequency:.1f} Hz).")
-            current_message_channels_log.append(1)
-            decoder_state = "CALIBRATING"
-            training_sequence_index = 0
-            calibrated_frequencies = {} # Clear previous calibration
-            has_been_calibrated = False
-            calibrated_frequencies[1] = actual_average_frequency # Calibrate Preamble channel
-            print(f"  Calibrated Ch 1 to {actual_average_frequency:.1f} Hz")
-            print(f"State Transition: IDLE -> CALIBRATING. Waiting for Training Ch {TRAINING_SEQUENCE[0]}...")
+            log(f"Preamble Confirmed (Nominal Ch 1 @ {actual_average_frequency:.1f} Hz).")
+            DEC.current_message_channels_log.append(1)
+            DEC.state = "CALIBRATING"
+            DEC.training_sequence_index = 0
+            DEC.calibrated_frequencies = {} # Clear previous calibration
+            DEC.has_been_calibrated = False
+            DEC.calibrated_frequencies[1] = actual_average_frequency # Calibrate Preamble channel
+            log(f"  Calibrated Ch 1 to {actual_average_frequency:.1f} Hz")
+            log(f"State Transition: IDLE -> CALIBRATING. Waiting for Training Ch {TRAINING_SEQUENCE[0]}...")
         else:
             pass # Suppress repeated "Ignored Ch..." messages in IDLE state
 
-    elif decoder_state == "CALIBRATING":
-        if training_sequence_index < len(TRAINING_SEQUENCE):
-            expected_calib_channel = TRAINING_SEQUENCE[training_sequence_index]
+    elif DEC.state == "CALIBRATING":
+        if DEC.training_sequence_index < len(TRAINING_SEQUENCE):
+            expected_calib_channel = TRAINING_SEQUENCE[DEC.training_sequence_index]
             nominal_freq_of_expected = NOMINAL_CHANNEL_FREQUENCIES.get(expected_calib_channel)
 
             if nominal_freq_of_expected is None:
-                print(f"Error: Expected calibration channel {expected_calib_channel} not in nominal map. Resetting.")
+                log(f"Error: Expected calibration channel {expected_calib_channel} not in nominal map. Resetting.")
                 reset_decoder_full_including_calibration()
                 return
 
@@ -415,170 +717,154 @@ def fsm_process_confirmed_tone(confirmed_channel_id_used_for_detection, actual_a
                 sane_tolerance_hz = nominal_freq_of_expected * CALIBRATION_SANE_TOLERANCE_FACTOR
 
                 if sane_diff <= sane_tolerance_hz:
-                    calibrated_frequencies[expected_calib_channel] = actual_average_frequency
-                    current_message_channels_log.append(expected_calib_channel) # Log the *expected* channel ID
-                    print(f"  Calibrated Ch {expected_calib_channel} to {actual_average_frequency:.1f} Hz (Nominal: {nominal_freq_of_expected:.1f} Hz).")
-                    training_sequence_index += 1
-
-                    if training_sequence_index == len(TRAINING_SEQUENCE):
-                        if len(calibrated_frequencies) == len(NOMINAL_CHANNEL_FREQUENCIES):
-                            print("Calibration sequence complete.")
-                            decoder_state = "READING_HEADER" # New state for header
-                            has_been_calibrated = True
-                            print("State Transition: CALIBRATING -> READING_HEADER. Waiting for message header...")
+                    DEC.calibrated_frequencies[expected_calib_channel] = actual_average_frequency
+                    DEC.current_message_channels_log.append(expected_calib_channel) # Log the *expected* channel ID
+                    log(f"  Calibrated Ch {expected_calib_channel} to {actual_average_frequency:.1f} Hz (Nominal: {nominal_freq_of_expected:.1f} Hz).")
+                    DEC.training_sequence_index += 1
+
+                    if DEC.training_sequence_index == len(TRAINING_SEQUENCE):
+                        if len(DEC.calibrated_frequencies) == len(NOMINAL_CHANNEL_FREQUENCIES):
+                            log("Calibration sequence complete.")
+                            DEC.state = "READING_HEADER" # New state for header
+                            DEC.has_been_calibrated = True
+                            set_calibrated_channel_arrays(DEC.calibrated_frequencies)
+                            DEC.detect_block = detect_block_calibrated
+                            log("State Transition: CALIBRATING -> READING_HEADER. Waiting for message header...")
                             
                             # --- CRITICAL ADDITION: Reset tone tracking after calibration ---
                             # This ensures the first header tone is correctly detected as a new segment.
-                            current_tone_candidate_nominal_chan = None
-                            current_tone_candidate_blocks = 0
-                            fsm_informed_of_this_segment = False
-                            current_tone_candidate_freq_samples = []
-                            recent_detections_nominal_chan.clear() # Clear deque too!
+                            DEC.current_tone_candidate_nominal_chan = None
+                            DEC.current_tone_candidate_blocks = 0
+                            DEC.fsm_informed_of_this_segment = False
+                            DEC.current_tone_candidate_freq_sum = 0.0
+                            DEC.current_tone_candidate_freq_count = 0
+                            DEC.recent_detections_count = 0 # Empty the vote window too!
                             # --- END CRITICAL ADDITION ---
 
                         else:
-                            print("Warning: Calibration sequence finished but not all channels recorded. Resetting.")
+                            log("Warning: Calibration sequence finished but not all channels recorded. Resetting.")
                             reset_decoder_full_including_calibration()
                     else:
-                        print(f"  Waiting for Training Ch {TRAINING_SEQUENCE[training_sequence_index]}...")
+                        log(f"  Waiting for Training Ch {TRAINING_SEQUENCE[DEC.training_sequence_index]}...")
                 else:
-                    print(f"Error: Calibration sanity check failed for Ch {expected_calib_channel}. Freq {actual_average_frequency:.1f} Hz is too far from nominal {nominal_freq_of_expected:.1f} Hz (>{sane_tolerance_hz:.1f} Hz). Resetting.")
+                    log(f"Error: Calibration sanity check failed for Ch {expected_calib_channel}. Freq {actual_average_frequency:.1f} Hz is too far from nominal {nominal_freq_of_expected:.1f} Hz (>{sane_tolerance_hz:.1f} Hz). Resetting.")
                     reset_decoder_full_including_calibration()
             else:
-                print(f"Error: During calibration for Ch {expected_calib_channel}, detected frequency {actual_average_frequency:.1f} Hz is outside {FREQUENCY_TOLERANCE} Hz tolerance from its nominal {nominal_freq_of_expected:.1f} Hz. Resetting.")
+                log(f"Error: During calibration for Ch {expected_calib_channel}, detected frequency {actual_average_frequency:.1f} Hz is outside {FREQUENCY_TOLERANCE} Hz tolerance from its nominal {nominal_freq_of_expected:.1f} Hz. Resetting.")
                 reset_decoder_full_including_calibration()
         else:
-            print("Error: training_sequence_index out of bounds in CALIBRATING. Resetting.")
+            log("Error: training_sequence_index out of bounds in CALIBRATING. Resetting.")
             reset_decoder_full_including_calibration()
 
-    elif decoder_state == "READING_HEADER" or decoder_state == "RECEIVING_DATA":
+    elif DEC.state == "READING_HEADER" or DEC.state == "RECEIVING_DATA":
         data_channel = confirmed_channel_id_used_for_detection
-
-        if data_channel == 1: # Postamble
-            print(f"Postamble Confirmed (Calibrated Ch 1 @ {actual_average_frequency:.1f} Hz).")
-            # If we received a postamble, it means message is done. Handle incomplete states.
-            if header_parsed:
-                if payload_bytes_received < file_metadata["payload_size"]:
-                    print(f"  Warning: Payload transmission ended prematurely. Expected {file_metadata['payload_size']} bytes, got {payload_bytes_received}.")
-            else: # Header was not parsed completely
-                print(f"  Warning: Message ended without a complete header. Current header_buffer: {[f'{b:02X}' for b in header_buffer]}.")
-
-            current_message_channels_log.append(1)
-            reset_decoder_after_message_or_error()
-            return
-
-        current_message_channels_log.append(data_channel)
-
-        if 4 <= data_channel <= 19: # Hex digit (0-F)
-            hex_val = data_channel - 4
-            current_byte_channels_debug.append(data_channel)
-
-            if byte_processing_state == "EXPECT_HIGH_NIBBLE":
-                current_high_nibble_value = hex_val
-                byte_processing_state = "EXPECT_LOW_NIBBLE"
-            elif byte_processing_state == "EXPECT_LOW_NIBBLE":
-                if current_high_nibble_value is not None:
-                    full_byte_val = (current_high_nibble_value << 4) | hex_val
-                    process_decoded_byte(full_byte_val) # Call helper here
-                    current_high_nibble_value = None
-                    byte_processing_state = "EXPECT_BYTE_SEPARATOR"
-                    current_byte_channels_debug = []
-                else:
-                    print(f"Error: Low Nibble (Ch {data_channel}) received without a registered High Nibble. Resetting.")
-                    reset_decoder_after_message_or_error()
-            else:
-                print(f"Error: Hex digit Ch {data_channel} received at unexpected state ({byte_processing_state}). Resetting.")
-                reset_decoder_after_message_or_error()
-
-        elif data_channel == 2: # Byte Separator
-            current_byte_channels_debug.append(data_channel)
-            if byte_processing_state == "EXPECT_BYTE_SEPARATOR":
-                byte_processing_state = "EXPECT_HIGH_NIBBLE"
-            elif byte_processing_state == "EXPECT_LOW_NIBBLE" and current_high_nibble_value is not None:
-                # --- ERROR RECOVERY (Duplicate Nibble) - Warning suppressed ---
-                # print(f"Warning: Missing Low Nibble for byte (expected Ch 4-19, got Ch 2). Assuming duplicate of High Nibble ({current_high_nibble_value:X}).")
-                full_byte_val = (current_high_nibble_value << 4) | current_high_nibble_value
-                process_decoded_byte(full_byte_val) # Process the reconstructed byte
-                
-                current_high_nibble_value = None # Clear for next byte
-                byte_processing_state = "EXPECT_HIGH_NIBBLE" # Ready for next byte's high nibble
-                current_byte_channels_debug = [] # Clear debug for this "repaired" byte
-            else:
-                print(f"Error: Byte Separator (Ch 2) received at unexpected state ({byte_processing_state}). Resetting.")
-                reset_decoder_after_message_or_error()
-
-        elif data_channel == 3: # Ch3 is only part of calibration/training now. If seen during message, it's an error.
-             print(f"Error: Ch 3 detected in message phase. This channel is not used as a separator anymore. Resetting.")
-             reset_decoder_after_message_or_error()
-
-        else: # Unrecognized channel
-            print(f"Warning: Unexpected Ch {data_channel} ({actual_average_frequency:.1f} Hz) in message state. Resetting message attempt.")
-            reset_decoder_after_message_or_error()
+        DEC.current_message_channels_log.append(data_channel)
+        if 0 <= data_channel < len(MESSAGE_CHANNEL_HANDLERS):
+            MESSAGE_CHANNEL_HANDLERS[data_channel](data_channel, actual_average_frequency)
+        else:
+            handle_unexpected_channel(data_channel, actual_average_frequency)
     else:
-        print(f"Warning: FSM in unhandled state: {decoder_state}. Full reset.")
+        log(f"Warning: FSM in unhandled state: {DEC.state}. Full reset.")
         reset_decoder_full_including_calibration()
 
+def raise_decoder_thread_priority():
+    """Tries to move the calling thread to the SCHED_FIFO real-time scheduling class."""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(DECODER_THREAD_RT_PRIORITY))
+    except (AttributeError, OSError):
+        pass # Not Linux, or not permitted: the default priority still works, with more jitter
+
 def audio_callback(indata, frames, time_info, status):
     """
-    Audio stream callback function. Processes incoming audio blocks.
-    Identifies dominant frequencies and feeds them to the FSM.
+    Audio stream callback function. Copies channel 0 of the block into the audio ring
+    and hands it to decoder_worker(); no analysis runs on the audio thread.
     """
-    global current_tone_candidate_nominal_chan, current_tone_candidate_blocks, fsm_informed_of_this_segment
-    global decoder_state, current_tone_candidate_freq_samples
-
     if status:
         pass # Suppress "Input overflow" warnings if they happen too frequently and are harmless
 
-    mono_data = indata[:, 0] if indata.ndim > 1 else indata
-    dominant_freq_this_block = get_dominant_frequency(mono_data, SAMPLING_RATE)
+    if audio_ring_ready.qsize() >= AUDIO_RING_SLOTS - 1:
+        return # Decoder is too far behind: drop this block rather than overwrite queued ones
 
-    use_nominal_map_for_this_detection = (decoder_state == "IDLE" or decoder_state == "CALIBRATING")
-    detected_channel_this_block = find_closest_channel(dominant_freq_this_block, use_nominal_map_only=use_nominal_map_for_this_detection)
+    n_samples = min(len(indata), BLOCKSIZE_SAMPLES)
+    slot = next(audio_ring_slots)
+    np.copyto(audio_ring[slot, :n_samples], indata[:n_samples, 0] if indata.ndim == 2 else indata[:n_samples])
+    audio_ring_lengths[slot] = n_samples
+    audio_ring_ready.put_nowait(slot)
 
-    recent_detections_nominal_chan.append(detected_channel_this_block)
+def decoder_worker():
+    """Decodes blocks queued by audio_callback, in order, until it receives None."""
+    raise_decoder_thread_priority()
+    try:
+        while True:
+            slot = audio_ring_ready.get()
+            if slot is None:
+                break
+            n_samples = audio_ring_lengths[slot]
+            process_audio_block(audio_ring[slot] if n_samples == BLOCKSIZE_SAMPLES else audio_ring[slot, :n_samples])
+    finally:
+        stop_event.set() # Wake the main thread, also if decoding raised
+
+def process_audio_block(mono_data):
+    """
+    Processes one mono audio block: identifies the dominant channel,
+    tracks tone segments and feeds confirmed tones to the FSM.
+    """
+    dec = DEC # Local alias: a fast local load instead of a module global lookup per access
 
-    if len(recent_detections_nominal_chan) < recent_detections_nominal_chan.maxlen:
-        return
+    # Energy gate: one dot product (squared RMS, no sqrt) instead of analysing a silent block
+    if np.dot(mono_data, mono_data) < SILENCE_RMS_THRESHOLD * SILENCE_RMS_THRESHOLD * len(mono_data):
+        detected_channel_this_block, dominant_freq_this_block = None, None
+    else:
+        detected_channel_this_block, dominant_freq_this_block = dec.detect_block(mono_data)
 
-    counts = collections.Counter(d for d in recent_detections_nominal_chan if d is not None)
-    stable_detected_channel_candidate = None
+    dec.recent_detections_nominal_chan[dec.recent_detections_index] = detected_channel_this_block
+    dec.recent_detections_index = (dec.recent_detections_index + 1) % RECENT_DETECTIONS_LEN
 
-    if counts:
-        most_common_ch, num_most_common = counts.most_common(1)[0]
-        if num_most_common >= recent_detections_nominal_chan.maxlen -1 :
-            stable_detected_channel_candidate = most_common_ch
+    if dec.recent_detections_count < RECENT_DETECTIONS_LEN:
+        dec.recent_detections_count += 1
+        if dec.recent_detections_count < RECENT_DETECTIONS_LEN:
+            return
 
-    if stable_detected_channel_candidate == current_tone_candidate_nominal_chan:
-        if current_tone_candidate_nominal_chan is not None:
-            current_tone_candidate_blocks += 1
+    # 2-of-3 majority vote over the recent detections (a None majority means no candidate)
+    d0, d1, d2 = dec.recent_detections_nominal_chan
+    if d0 == d1 or d0 == d2:
+        stable_detected_channel_candidate = d0
+    elif d1 == d2:
+        stable_detected_channel_candidate = d1
+    else:
+        stable_detected_channel_candidate = None
+
+    if stable_detected_channel_candidate == dec.current_tone_candidate_nominal_chan:
+        if dec.current_tone_candidate_nominal_chan is not None:
+            dec.current_tone_candidate_blocks += 1
             if dominant_freq_this_block is not None:
-                 current_tone_candidate_freq_samples.append(dominant_freq_this_block)
+                 dec.current_tone_candidate_freq_sum += dominant_freq_this_block
+                 dec.current_tone_candidate_freq_count += 1
     else:
-        current_tone_candidate_nominal_chan = stable_detected_channel_candidate
-        current_tone_candidate_blocks = 1 if stable_detected_channel_candidate is not None else 0
-        fsm_informed_of_this_segment = False
-        current_tone_candidate_freq_samples = []
+        dec.current_tone_candidate_nominal_chan = stable_detected_channel_candidate
+        dec.current_tone_candidate_blocks = 1 if stable_detected_channel_candidate is not None else 0
+        dec.fsm_informed_of_this_segment = False
+        dec.current_tone_candidate_freq_sum = 0.0
+        dec.current_tone_candidate_freq_count = 0
         if dominant_freq_this_block is not None and stable_detected_channel_candidate is not None:
-            current_tone_candidate_freq_samples.append(dominant_freq_this_block)
+            dec.current_tone_candidate_freq_sum = dominant_freq_this_block
+            dec.current_tone_candidate_freq_count = 1
 
-    if current_tone_candidate_nominal_chan is not None and not fsm_informed_of_this_segment:
-        is_long_duration_type_context = (current_tone_candidate_nominal_chan == 1)
-        min_blocks_needed = MIN_CONSECUTIVE_BLOCKS_FOR_PREAMBLE if is_long_duration_type_context else MIN_CONSECUTIVE_BLOCKS_FOR_CHANNEL
-
-        if current_tone_candidate_blocks >= min_blocks_needed:
+    if dec.current_tone_candidate_nominal_chan is not None and not dec.fsm_informed_of_this_segment:
+        if dec.current_tone_candidate_blocks >= MIN_BLOCKS_BY_CHANNEL[dec.current_tone_candidate_nominal_chan]:
             avg_freq_for_segment = None
-            if current_tone_candidate_freq_samples:
-                avg_freq_for_segment = np.mean(current_tone_candidate_freq_samples)
+            if dec.current_tone_candidate_freq_count:
+                avg_freq_for_segment = dec.current_tone_candidate_freq_sum / dec.current_tone_candidate_freq_count
             
-            if avg_freq_for_segment is None and current_tone_candidate_nominal_chan is not None:
+            if avg_freq_for_segment is None and dec.current_tone_candidate_nominal_chan is not None:
                  current_map = get_channel_map_for_find()
-                 fallback_freq = current_map.get(current_tone_candidate_nominal_chan, NOMINAL_CHANNEL_FREQUENCIES.get(current_tone_candidate_nominal_chan, 0))
+                 fallback_freq = current_map.get(dec.current_tone_candidate_nominal_chan, NOMINAL_CHANNEL_FREQUENCIES.get(dec.current_tone_candidate_nominal_chan, 0))
                  if fallback_freq != 0:
                      avg_freq_for_segment = fallback_freq
 
             if avg_freq_for_segment is not None:
-                fsm_process_confirmed_tone(current_tone_candidate_nominal_chan, avg_freq_for_segment)
-                fsm_informed_of_this_segment = True
+                fsm_process_confirmed_tone(dec.current_tone_candidate_nominal_chan, avg_freq_for_segment)
+                dec.fsm_informed_of_this_segment = True
 
 
 # --- Main Program ---
@@ -595,8 +881,8 @@ if __name__ == "__main__":
     
     print(f"\nTarget Channel Duration: {CHANNEL_DURATION*1000:.0f} ms")
     print(f"Preamble Duration: {PREAMBLE_DURATION*1000:.0f} ms")
-    print(f"Analysis Blocksize: {BLOCKSIZE_SECONDS*1000:.0f} ms ({BLOCKSIZE_SAMPLES} samples)")
-    print(f"FFT Freq. Resolution: ~{SAMPLING_RATE/BLOCKSIZE_SAMPLES:.0f} Hz/bin")
+    print(f"Analysis Blocksize: {BLOCKSIZE_SECONDS*1000:.1f} ms ({BLOCKSIZE_SAMPLES} samples)")
+    print(f"FFT Length: {FFT_N} samples (Freq. Resolution: ~{SAMPLING_RATE/FFT_N:.0f} Hz/bin)")
     print(f"Min blocks for channel tone: {MIN_CONSECUTIVE_BLOCKS_FOR_CHANNEL} ({MIN_CONSECUTIVE_BLOCKS_FOR_CHANNEL*BLOCKSIZE_SECONDS*1000:.0f} ms)")
     print(f"Min blocks for preamble: {MIN_CONSECUTIVE_BLOCKS_FOR_PREAMBLE} ({MIN_CONSECUTIVE_BLOCKS_FOR_PREAMBLE*BLOCKSIZE_SECONDS*1000:.0f} ms)")
     print(f"Frequency Tolerance: +/- {FREQUENCY_TOLERANCE} Hz")
@@ -604,16 +890,31 @@ if __name__ == "__main__":
     print(f"Received files will be saved in: {os.getcwd()}")
 
 
+    console_thread = threading.Thread(target=console_writer, daemon=True)
+    console_thread.start()
+
     reset_decoder_soft()
+    decoder_thread = threading.Thread(target=decoder_worker, daemon=True)
+    decoder_thread.start()
     try:
         with sd.InputStream(device=INPUT_DEVICE_ID, channels=1, samplerate=SAMPLING_RATE,
-                            blocksize=BLOCKSIZE_SAMPLES, callback=audio_callback):
-            while True:
-                time.sleep(0.5)
+                            blocksize=BLOCKSIZE_SAMPLES, dtype='float32', latency='low',
+                            callback=audio_callback, finished_callback=stop_event.set):
+            while not stop_event.wait(MAIN_THREAD_WAIT_TIMEOUT):
+                pass
+        log("\nAudio stream or decoder stopped.")
     except KeyboardInterrupt:
-        print("\nStopping decoder.")
+        log("\nStopping decoder.")
+        audio_ring_ready.put(None) # The stream is closed; let the worker finish queued blocks first
+        decoder_thread.join()
         reset_decoder_after_message_or_error()
     except Exception as e:
-        print(f"An error occurred: {e}")
+        log(f"An error occurred: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        if decoder_thread.is_alive():
+            audio_ring_ready.put(None)
+            decoder_thread.join()
+        log_queue.put(None) # Let the writer finish what's queued, then stop
+        console_thread.join()
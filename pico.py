@@ -8,6 +8,8 @@
 """
 
 import time
+import array
+import struct
 import board
 import rp2pio
 import adafruit_pioasm
@@ -20,165 +22,221 @@ NUM_TOTAL_CHANNELS = 19 # Channels 1 through 19
 # Calculate the frequency step for linear spacing
 FREQ_STEP = (MAX_OPERATING_FREQ_HZ - MIN_OPERATING_FREQ_HZ) / (NUM_TOTAL_CHANNELS - 1)
 
-CHANNEL_FREQUENCIES = {}
-for i in range(1, NUM_TOTAL_CHANNELS + 1):
-    CHANNEL_FREQUENCIES[i] = MIN_OPERATING_FREQ_HZ + (i - 1) * FREQ_STEP
+# Output frequency of each channel, indexed by channel_id - 1
+CHANNEL_FREQUENCIES = tuple(MIN_OPERATING_FREQ_HZ + i * FREQ_STEP for i in range(NUM_TOTAL_CHANNELS))
+
+# Per-message progress output. print() over USB serial can block for milliseconds, so it is off
+# by default; the `if VERBOSE:` branches are skipped entirely when disabled.
+VERBOSE = False
 
 # --- Timing Constants ---
-# Duration of a single channel tone (Pico's 'DI' now maps to CHANNEL_DURATION)
-CHANNEL_DURATION = 0.03  # 30 ms
-PREAMBLE_DURATION = 1.0  # 1 second for preamble/postamble
+# Duration of a single channel tone (Pico's 'DI' now maps to CHANNEL_DURATION_NS), in integer
+# nanoseconds so tone lengths are computed without float rounding
+CHANNEL_DURATION_NS = 30000000  # 30 ms
+PREAMBLE_DURATION_NS = 1000000000  # 1 second for preamble/postamble
+# How often transmit_full_message checks whether the PIO has played the whole tone plan
+TRANSMIT_POLL_INTERVAL = 0.01
+# Tones per DMA buffer of the tone plan. Three buffers rotate (see write_tone_plan), so the plan
+# takes 3 * 4 * PLAN_CHUNK_TONES bytes of RAM whatever the message size.
+PLAN_CHUNK_TONES = 256
 
 # --- Protocol Constants (MUST MATCH RECEIVER) ---
 HEADER_START_DELIMITER = 0xFE
 MESSAGE_TYPE_TEXT = 0x00
 MESSAGE_TYPE_FILE = 0x01
 HEADER_END_DELIMITER = 0xFF
+# Preamble (Channel 1), then the Training Sequence: Channel 2, then 3, then channels 4-19
+HEADER_TONES = bytes((1, 2, 3) + tuple(range(4, 20)))
 
 # --- PIO Program for Square Wave Generation ---
-# This PIO program generates a square wave by rapidly toggling the pin.
-# `set pins, 0` sets the pin low (1 cycle).
-# `set pins, 1` sets the pin high (1 cycle).
-# A full period is 2 PIO clock cycles.
-# So, desired_output_frequency = PIO_SM_clock_frequency / 2.
-# Therefore, PIO_SM_clock_frequency = desired_output_frequency * 2.
-PIO_CYCLES_PER_PERIOD = 2 # Based on the pio_generator program below
+# The PIO program plays a whole message on its own, one tone per 32-bit word pulled from the TX FIFO:
+#   bits  0-15: half-period delay D (loop count of each half of the square wave)
+#   bits 16-31: number of square wave periods to play, minus one
+# Each period takes 2 * D + 7 PIO clock cycles (the two `set`, two `mov`, the final `jmp x--`
+# and one extra pass through each delay loop), so
+# output_frequency = PIO_SM_clock_frequency / (2 * D + 7).
+# With the FIFO empty the program stalls on `pull` with the pin low, i.e. silence.
+PIO_PERIOD_OVERHEAD_CYCLES = 7 # Based on the pio_generator program below
+PIO_SM_FREQUENCY = 0 # Run the StateMachine at the full system clock (typically 125 MHz)
 
 # The PIO program to generate a square wave
-# Note: No `[delay]` is used here, aiming for max precision.
 pio_generator = adafruit_pioasm.assemble(
     """
     .program hfsk_tx
-    set pins, 0 ; Set pin low
-    set pins, 1 ; Set pin high
+        pull block      ; Wait for the next tone word
+        out isr, 16     ; ISR = half-period delay
+        out x, 16       ; X = periods - 1
+    period:
+        set pins, 1     ; Set pin high
+        mov y, isr
+    high:
+        jmp y-- high
+        set pins, 0     ; Set pin low
+        mov y, isr
+    low:
+        jmp y-- low
+        jmp x-- period
     """
 )
 
-# --- Helper Functions ---
+# Rotating DMA buffers for the tone plan, allocated once rather than per message
+plan_buffers = tuple(array.array('L', [0] * PLAN_CHUNK_TONES) for _ in range(3))
 
-def to_little_endian_bytes(value, num_bytes):
-    """Converts an integer to a little-endian bytearray."""
-    return value.to_bytes(num_bytes, 'little')
+# --- Helper Functions ---
 
-def transmit_channel(channel_id, duration):
+def create_state_machine():
     """
-    Transmits a square wave signal at the specified HFSK channel ID for the given duration
-    directly on a GPIO pin using PIO.
+    Creates the PIO StateMachine that generates the square wave.
+    It is created once per transmission and plays every tone from its TX FIFO.
     """
-    if channel_id not in CHANNEL_FREQUENCIES:
-        print(f"Error: Invalid channel ID {channel_id}")
-        return
-
-    target_output_frequency = CHANNEL_FREQUENCIES[channel_id]
-    
-    # Calculate the required PIO StateMachine clock frequency to achieve the target_output_frequency
-    # PIO_SM_clock_frequency = target_output_frequency * PIO_CYCLES_PER_PERIOD
-    # The Pico's system clock is typically 125 MHz. Ensure sm_frequency doesn't exceed this.
-    # For 10kHz-18kHz, this is well within limits.
-    sm_frequency = int(target_output_frequency * PIO_CYCLES_PER_PERIOD)
-
-    # Instantiate and start the PIO StateMachine
-    sm = rp2pio.StateMachine(
+    return rp2pio.StateMachine(
         pio_generator,
-        frequency=sm_frequency,
+        frequency=PIO_SM_FREQUENCY,
         first_set_pin=board.GP16, # The GPIO pin to output the square wave
         set_pins=(board.GP16,)    # Pins that `set pins` instruction affects
     )
-    # print(f"Transmitting Ch {channel_id} ({target_output_frequency:.1f} Hz) for {duration*1000:.0f} ms...")
-    time.sleep(duration)  # Keep the signal active for the specified duration
-    sm.deinit()  # Stop the signal and release PIO resources
+
+def tone_word(sm_frequency, channel_id, duration_ns):
+    """
+    Returns the PIO tone word that plays the given HFSK channel ID for duration_ns nanoseconds
+    on a StateMachine running at sm_frequency.
+    """
+    if not 1 <= channel_id <= NUM_TOTAL_CHANNELS:
+        raise ValueError(f"Invalid channel ID {channel_id}")
+
+    # The delay is quantized to whole PIO cycles, so size the tone from the frequency that is
+    # actually output rather than the nominal one. At 125 MHz that is within ~2 Hz of nominal.
+    # For 10kHz-18kHz at 125 MHz the delay (~3.5k-6.2k) and the preamble's period count
+    # (<= 18k) both fit comfortably in 16 bits.
+    half_period_delay = int(round((sm_frequency / CHANNEL_FREQUENCIES[channel_id - 1] - PIO_PERIOD_OVERHEAD_CYCLES) / 2))
+    period_cycles = 2 * half_period_delay + PIO_PERIOD_OVERHEAD_CYCLES
+    # periods = round(duration_ns * sm_frequency / (period_cycles * 1e9)), in integer arithmetic
+    periods = max(1, (2 * duration_ns * sm_frequency + period_cycles * 1000000000) // (2 * period_cycles * 1000000000))
+    return ((periods - 1) << 16) | half_period_delay
+
+def channel_tone_words(sm_frequency, duration_ns):
+    """Returns the tone word of every channel for the given duration, indexed by channel_id - 1."""
+    return tuple(tone_word(sm_frequency, channel_id, duration_ns) for channel_id in range(1, NUM_TOTAL_CHANNELS + 1))
 
 def create_header(message_type, raw_data_bytes, filename="", file_extension=""):
     """
     Creates the protocol header for text or file data.
     Returns a bytearray.
     """
-    header_parts = bytearray()
-    header_parts.append(HEADER_START_DELIMITER)
-    header_parts.append(message_type)
-
+    # Fields are packed little-endian straight into a header buffer of the exact size.
     if message_type == MESSAGE_TYPE_FILE:
         filename_bytes = filename.encode('utf-8')
         extension_bytes = file_extension.encode('utf-8')
-
-        header_parts.extend(to_little_endian_bytes(len(filename_bytes), 2)) # Filename Length (UInt16)
-        header_parts.extend(filename_bytes)
-        header_parts.extend(to_little_endian_bytes(len(extension_bytes), 2)) # Extension Length (UInt16)
-        header_parts.extend(extension_bytes)
-        header_parts.extend(to_little_endian_bytes(len(raw_data_bytes), 4)) # Raw File Data Size (UInt32)
+        filename_len = len(filename_bytes)
+        extension_len = len(extension_bytes)
+
+        header_parts = bytearray(2 + 2 + filename_len + 2 + extension_len + 4 + 1)
+        struct.pack_into('<BBH', header_parts, 0, HEADER_START_DELIMITER, message_type, filename_len) # Filename Length (UInt16)
+        offset = 4
+        header_parts[offset:offset + filename_len] = filename_bytes
+        offset += filename_len
+        struct.pack_into('<H', header_parts, offset, extension_len) # Extension Length (UInt16)
+        offset += 2
+        header_parts[offset:offset + extension_len] = extension_bytes
+        offset += extension_len
+        struct.pack_into('<I', header_parts, offset, len(raw_data_bytes)) # Raw File Data Size (UInt32)
     elif message_type == MESSAGE_TYPE_TEXT:
-        header_parts.extend(to_little_endian_bytes(len(raw_data_bytes), 4)) # Raw Text Data Size (UInt32)
+        header_parts = bytearray(2 + 4 + 1)
+        struct.pack_into('<BBI', header_parts, 0, HEADER_START_DELIMITER, message_type, len(raw_data_bytes)) # Raw Text Data Size (UInt32)
+    else:
+        header_parts = bytearray(2 + 1)
+        header_parts[0] = HEADER_START_DELIMITER
+        header_parts[1] = message_type
     
-    header_parts.append(HEADER_END_DELIMITER)
+    header_parts[-1] = HEADER_END_DELIMITER
     return header_parts
 
-def get_channel_sequence(payload_bytes):
+def payload_tone_words(payload_bytes, tone_words, postamble_word):
     """
-    Generates the sequence of channel IDs for the full payload (header + data).
+    Yields the tone word of every tone for the full payload (header + data), straight from the
+    payload bytes, followed by postamble_word. tone_words is indexed by channel_id - 1
+    (see channel_tone_words).
     """
-    channel_sequence = []
-
-    # Preamble
-    channel_sequence.append(1)
-
-    # Training Sequence: Channel 2, then 3, then channels 4-19
-    training_sequence = [2, 3] 
-    for i in range(4, 20): # Channels 4 through 19
-        training_sequence.append(i)
-    channel_sequence.extend(training_sequence)
-
-    # Convert payload bytes to channel IDs
+    separator_word = tone_words[1] # Byte Separator (Channel 2)
     for byte_val in payload_bytes:
-        high_nibble = (byte_val >> 4) & 0xF  # Get the 4 most significant bits (0-15)
-        low_nibble = byte_val & 0xF         # Get the 4 least significant bits (0-15)
-
-        # Transmit High Nibble (channel 4-19 for values 0-F)
-        # hex_value (0-15) + 4 = channel_id (4-19)
-        channel_sequence.append(high_nibble + 4)
-
-        # Transmit Low Nibble (channel 4-19 for values 0-F)
-        channel_sequence.append(low_nibble + 4)
-
-        # Transmit Byte Separator (Channel 2) after each completed byte
-        channel_sequence.append(2)
-    
-    # Postamble
-    channel_sequence.append(1)
-    
-    return channel_sequence
+        # High Nibble, then Low Nibble (channel 4-19 for values 0-F)
+        # hex_value (0-15) + 4 = channel_id (4-19), so its index is hex_value + 3
+        yield tone_words[((byte_val >> 4) & 0xF) + 3]
+        yield tone_words[(byte_val & 0xF) + 3]
+        # Byte Separator after each completed byte
+        yield separator_word
+    yield postamble_word
+
+def write_tone_plan(sm, words):
+    """
+    Queues the tone words from the iterable `words` on the StateMachine in PLAN_CHUNK_TONES chunks,
+    returning once the last chunk is queued.
+    background_write() only returns after the previously queued buffer has started, so by the
+    time a buffer comes round again (every third chunk) the DMA is done with it.
+    """
+    buffer_index = 0
+    buffer = plan_buffers[0]
+    count = 0
+    for word in words:
+        buffer[count] = word
+        count += 1
+        if count == PLAN_CHUNK_TONES:
+            sm.background_write(buffer)
+            buffer_index = (buffer_index + 1) % len(plan_buffers)
+            buffer = plan_buffers[buffer_index]
+            count = 0
+    if count:
+        sm.background_write(memoryview(buffer)[:count])
 
 def transmit_full_message(message_type, raw_data, filename="", file_extension=""):
     """
     Builds the header and payload, then transmits the full channel sequence.
     """
-    print(f"Preparing transmission of type: {'TEXT' if message_type == MESSAGE_TYPE_TEXT else 'FILE'}")
-    print(f"Raw data size: {len(raw_data)} bytes")
+    if VERBOSE:
+        print(f"Preparing transmission of type: {'TEXT' if message_type == MESSAGE_TYPE_TEXT else 'FILE'}")
+        print(f"Raw data size: {len(raw_data)} bytes")
 
     header_bytes = create_header(message_type, raw_data, filename, file_extension)
-    print(f"Header size: {len(header_bytes)} bytes")
+    if VERBOSE:
+        print(f"Header size: {len(header_bytes)} bytes")
 
     # Combine header and raw data into the full payload
     full_payload = bytearray()
     full_payload.extend(header_bytes)
     full_payload.extend(raw_data)
-    print(f"Total payload to encode: {len(full_payload)} bytes")
-
-    channel_sequence = get_channel_sequence(full_payload)
-    print(f"Total channel tones to transmit: {len(channel_sequence)}")
+    if VERBOSE:
+        print(f"Total payload to encode: {len(full_payload)} bytes")
 
-    print("\n--- Starting Transmission ---")
+    # Preamble + 18 training tones + 3 tones per payload byte + Postamble
+    if VERBOSE:
+        print(f"Total channel tones to transmit: {1 + 18 + 3 * len(full_payload) + 1}")
+        print("\n--- Starting Transmission ---")
     
-    for i, channel_id in enumerate(channel_sequence):
-        duration = CHANNEL_DURATION
-        # Check for Preamble (first channel 1) or Postamble (last channel 1)
-        if channel_id == 1 and (i == 0 or i == len(channel_sequence) - 1):
-            duration = PREAMBLE_DURATION
-        
-        transmit_channel(channel_id, duration)
-        # Optional: Add a very small inter-tone silence if needed for stability
-        # time.sleep(0.001) 
+    sm = create_state_machine()
+    try:
+        tone_words = channel_tone_words(sm.frequency, CHANNEL_DURATION_NS)
+        preamble_word = tone_word(sm.frequency, 1, PREAMBLE_DURATION_NS)
+
+        # Preamble and Training Sequence, queued first so the PIO starts playing while the
+        # payload plan is filled
+        header_plan = array.array('L', [tone_words[channel_id - 1] for channel_id in HEADER_TONES])
+        header_plan[0] = preamble_word
+        sm.background_write(header_plan)
+
+        # Payload tones followed by the Postamble, streamed through the rotating plan buffers
+        write_tone_plan(sm, payload_tone_words(full_payload, tone_words, preamble_word))
+
+        while sm.writing:
+            time.sleep(TRANSMIT_POLL_INTERVAL)
+        # The last tones are still queued in the FIFO; the SM stalls on `pull` once they have played.
+        sm.clear_txstall()
+        while not sm.txstall:
+            time.sleep(TRANSMIT_POLL_INTERVAL)
+    finally:
+        sm.deinit()  # Stop the signal and release PIO resources
 
-    print("--- Transmission Complete ---")
+    if VERBOSE:
+        print("--- Transmission Complete ---")
 
 
 # --- Example Usage on Raspberry Pi Pico ---
@@ -207,6 +265,7 @@ transmit_full_message(MESSAGE_TYPE_FILE, dummy_file_content, filename=file_name,
 time.sleep(5)
 
 print("\n--- All examples finished. Looping transmissions indefinitely ---")
+repeating_text_bytes = b"Pico repeating text. " * 3 # Built once, not on every pass
 while True:
-    transmit_full_message(MESSAGE_TYPE_TEXT, b"Pico repeating text. " * 3)
+    transmit_full_message(MESSAGE_TYPE_TEXT, repeating_text_bytes)
     time.sleep(10)